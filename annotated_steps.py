@@ -5,6 +5,7 @@
 # BSD-style license that can be found in the LICENSE file.
 
 import imp
+import json
 import os
 import re
 import shutil
@@ -12,9 +13,11 @@ import shlex
 import subprocess
 import sys
 import tempfile
-import zipfile
+import time
+import urllib2
 
 import config_parser
+import zip_extractor
 
 # We expect the tools directory from the dart repo to be checked out into:
 # ../../tools
@@ -108,6 +111,116 @@ class BuildStep(object):
       if self.swallow_error and isinstance(value, OSError):
         return True
 
+class FailFast(object):
+  """
+  Orders independent test steps for fail-fast mode and tracks whether one of
+  them has already failed.
+
+  Per-step run counts, failure counts and durations are kept in a JSON file in
+  the build root, so that steps which have failed often relative to how long
+  they take are run first on the next build.
+  """
+  # Failure rate and duration assumed for steps without any history.
+  DEFAULT_FAILURE_RATE = 0.5
+  DEFAULT_SECONDS = 60.0
+
+  def __init__(self, history_file):
+    self.failed = False
+    self._history_file = history_file
+    self._history = self._load_history()
+
+  def _load_history(self):
+    if not os.path.isfile(self._history_file):
+      return {}
+    try:
+      with open(self._history_file) as f:
+        history = json.load(f)
+    except (IOError, ValueError) as e:
+      print 'Ignoring unreadable step history %s: %s' % (self._history_file, e)
+      return {}
+    if not isinstance(history, dict):
+      print 'Ignoring malformed step history %s' % self._history_file
+      return {}
+    return history
+
+  def _save_history(self):
+    with open(self._history_file, 'w') as f:
+      json.dump(self._history, f, indent=2, sort_keys=True)
+
+  def _entry(self, name):
+    # The history is only advisory, so treat malformed entries as missing.
+    entry = self._history.get(name)
+    if not isinstance(entry, dict):
+      return None
+    for key in ('runs', 'failures', 'seconds'):
+      if not isinstance(entry.get(key), (int, long, float)):
+        return None
+    if entry['runs'] <= 0:
+      return None
+    return entry
+
+  def _priority(self, name):
+    entry = self._entry(name)
+    if not entry:
+      return self.DEFAULT_FAILURE_RATE / self.DEFAULT_SECONDS
+    # Laplace smoothing keeps a single run from pinning the rate to 0 or 1.
+    failure_rate = (entry['failures'] + 1.0) / (entry['runs'] + 2.0)
+    seconds = max(entry['seconds'] / entry['runs'], 1.0)
+    return failure_rate / seconds
+
+  def order(self, steps):
+    # sorted is stable, so steps with equal priority keep their usual order.
+    return sorted(steps, key=lambda step: -self._priority(step[0]))
+
+  def record(self, name, failed, seconds):
+    entry = self._entry(name)
+    if not entry:
+      entry = {'runs': 0, 'failures': 0, 'seconds': 0.0}
+      self._history[name] = entry
+    entry['runs'] += 1
+    entry['failures'] += 1 if failed else 0
+    entry['seconds'] += seconds
+    if failed:
+      self.failed = True
+    self._save_history()
+
+def GetFailFast(bot_info, test_config):
+  if not test_config.get_fail_fast():
+    return None
+  history_file = os.path.join(GetBuildRoot(bot_info), 'step_history.json')
+  print 'Fail-fast mode enabled, using step history in %s' % history_file
+  return FailFast(history_file)
+
+def RunTestSteps(steps, fail_fast=None):
+  """
+  Runs steps, a list of (name, function) pairs, as BuildSteps that swallow
+  errors.
+
+  In fail-fast mode the steps are ordered by their historical failure rate
+  relative to their cost, and once any step has failed the remaining ones are
+  reported as skipped instead of being run. Steps that should be ranked
+  against each other must therefore be passed in a single call.
+  """
+  if fail_fast:
+    steps = fail_fast.order(steps)
+  for name, run in steps:
+    if fail_fast and fail_fast.failed:
+      with BuildStep(name):
+        print 'Skipped: an earlier step failed and fail-fast mode is enabled.'
+        print '@@@STEP_WARNINGS@@@'
+        sys.stdout.flush()
+      continue
+    failed = False
+    start = time.time()
+    with BuildStep(name, swallow_error=True):
+      try:
+        run()
+      except OSError:
+        failed = True
+        raise
+    if fail_fast:
+      fail_fast.record(name, failed, time.time() - start)
+
 class TempDir(object):
   def __init__(self, prefix=''):
     self._temp_dir = None
@@ -153,29 +266,48 @@ def RunProcess(command, shell=False, extra_env=None):
   if exit_code != 0:
     raise OSError(exit_code)
 
+# Seconds a single read from the sdk download may block before giving up.
+SDK_DOWNLOAD_TIMEOUT = 60
+SDK_DOWNLOAD_ATTEMPTS = 3
+
 def GetSDK(bot_info):
   with BuildStep('Get sdk'):
     namer = bot_utils.GCSNamer(channel=bot_utils.Channel.DEV)
     # TODO(ricow): Be smarter here, only download if new.
     build_root = GetBuildRoot(bot_info)
-    SafeDelete(os.path.join(build_root, 'dart-sdk'), bot_info)
     if not os.path.exists(build_root):
       os.makedirs(build_root)
-    local_zip = os.path.join(build_root, 'sdk.zip')
-    gsutils = bot_utils.GSUtil()
-    gsutils.execute(['cp',
-                    namer.sdk_zipfilepath('latest', bot_info.system,
-                                          'ia32', 'release'),
-                    local_zip])
-    if bot_info.system == 'windows':
-      with zipfile.ZipFile(local_zip, 'r') as zip_file:
-        zip_file.extractall(path=build_root)
-    else:
-      # We don't keep the execution bit if we use python's zipfile on posix.
-      RunProcess(['unzip', local_zip, '-d', build_root])
+    sdk_url = GetPublicUrl(namer.sdk_zipfilepath('latest', bot_info.system,
+                                                 'ia32', 'release'))
+    sdk_path = os.path.join(build_root, 'dart-sdk')
+    for attempt in range(1, SDK_DOWNLOAD_ATTEMPTS + 1):
+      SafeDelete(sdk_path, bot_info)
+      # We extract straight from the download instead of staging sdk.zip, and
+      # don't use python's zipfile since it drops the execution bit on posix.
+      print 'Extracting %s into %s (attempt %d of %d)' % (
+          sdk_url, build_root, attempt, SDK_DOWNLOAD_ATTEMPTS)
+      sys.stdout.flush()
+      try:
+        response = urllib2.urlopen(sdk_url, timeout=SDK_DOWNLOAD_TIMEOUT)
+        try:
+          zip_extractor.ExtractZipStream(response, build_root)
+        finally:
+          response.close()
+        break
+      except Exception as e:
+        print 'Getting the sdk failed: %s' % e
+        # Don't leave a half extracted sdk behind.
+        SafeDelete(sdk_path, bot_info)
+        if attempt == SDK_DOWNLOAD_ATTEMPTS:
+          raise
+        time.sleep(10 * attempt)
     pub = GetPub(bot_info)
     RunProcess([pub, '--version'])
 
+def GetPublicUrl(gs_path):
+  # The dart-archive bucket is public, so we can stream from it over https.
+  return gs_path.replace('gs://', 'https://storage.googleapis.com/', 1)
+
 def GetPackagePath(bot_info):
   if bot_info.is_repo:
     return os.path.join('pkg', bot_info.package_name)
@@ -308,7 +440,7 @@ def LogsArgument():
     return []
   return ['--append_logs']
 
-def RunPackageTesting(bot_info, package_path, folder='test'):
+def GetPackageTestingSteps(bot_info, package_path, folder='test'):
   package_name = os.path.basename(package_path)
   if package_name == '':
     # when package_path had a trailing slash
@@ -337,7 +469,7 @@ def RunPackageTesting(bot_info, package_path, folder='test'):
                    '--write-debug-log', '-v',
                    '--time',
                    '%s/%s/%s/' % (package_name, package_name, folder)]
-  with BuildStep('Test vm release mode%s' % suffix, swallow_error=True):
+  def RunVm():
     args = [sys.executable, 'tools/test.py',
             '-mrelease', '-rvm', '-cnone'] + standard_args
     args.extend(LogsArgument())
@@ -345,20 +477,28 @@ def RunPackageTesting(bot_info, package_path, folder='test'):
     # This only makes sense on vm testing.
     extra_env = { 'DART_SDK_BIN' : GetSdkBin(bot_info) }
     RunProcess(args, extra_env=extra_env)
-  with BuildStep('Test analyzer%s' % suffix, swallow_error=True):
+
+  def RunAnalyzer():
     args = [sys.executable, 'tools/test.py',
             '-mrelease', '-rnone', '-cdart2analyzer'] + standard_args
     args.extend(LogsArgument())
     RunProcess(args)
+
+  def RunDart2js(runtime):
+    test_args = [sys.executable, 'tools/test.py',
+                 '-mrelease', '-r%s' % runtime, '-cdart2js', '-j4',
+                 '--dart2js-batch']
+    args = test_args + standard_args
+    args.extend(LogsArgument())
+    _RunWithXvfb(bot_info, args)
+
+  steps = [('Test vm release mode%s' % suffix, RunVm),
+           ('Test analyzer%s' % suffix, RunAnalyzer)]
   # TODO(27065): Restore Dartium testing once it works on test.py again.
   for runtime in JS_RUNTIMES[bot_info.system]:
-    with BuildStep('dart2js-%s%s' % (runtime, suffix), swallow_error=True):
-      test_args = [sys.executable, 'tools/test.py',
-                   '-mrelease', '-r%s' % runtime, '-cdart2js', '-j4',
-                   '--dart2js-batch']
-      args = test_args + standard_args
-      args.extend(LogsArgument())
-      _RunWithXvfb(bot_info, args)
+    steps.append(('dart2js-%s%s' % (runtime, suffix),
+                  lambda runtime=runtime: RunDart2js(runtime)))
+  return steps
 
 def FillMagicMarkers(v, replacements):
   def replace(match):
@@ -445,10 +585,11 @@ def RunDefaultScript(bot_info, test_config, copy_path):
     print 'Running tests manually'
     FixupTestControllerJS(copy_path)
     RunPreTestHooks(test_config)
-    RunPackageTesting(bot_info, copy_path, 'test')
     # TODO(6): Packages that need barback should use the test package runner,
     # instead of trying to run from the build/test directory.
-    RunPackageTesting(bot_info, copy_path, 'build/test')
+    steps = (GetPackageTestingSteps(bot_info, copy_path, 'test') +
+             GetPackageTestingSteps(bot_info, copy_path, 'build/test'))
+    RunTestSteps(steps, GetFailFast(bot_info, test_config))
 
   RunPostTestHooks(test_config)
 
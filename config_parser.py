@@ -69,6 +69,8 @@ VALID_TYPES = {
   'use_custom_script' : _TestString,
   # Using or configuring the test package
   'test_package' : _TestPackageConfig,
+  # Run the test steps most likely to fail first and skip the rest on failure.
+  'fail_fast' : _TestBoolean,
 }
 
 """
@@ -141,6 +143,9 @@ class ConfigParser(object):
   def get_post_test_hooks(self):
     return self._get_hooks('post_test_hooks')
 
+  def get_fail_fast(self):
+    return self.config.get('fail_fast') or False
+
   def get_custom_script(self):
     return self.config.get('use_custom_script') or None
 
@@ -0,0 +1,372 @@
+#!/usr/bin/python
+# Copyright (c) 2014, the Dart project authors.  Please see the AUTHORS file
+# for details. All rights reserved. Use of this source code is governed by a
+# BSD-style license that can be found in the LICENSE file.
+
+import multiprocessing
+import os
+import Queue
+import stat
+import struct
+import threading
+import zlib
+
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+DATA_DESCRIPTOR_SIGNATURE = 0x08074b50
+END_SIGNATURES = [0x06054b50, 0x06064b50]
+
+LOCAL_HEADER = struct.Struct('<HHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<HHHHHHIIIHHHHHII')
+
+STORED = 0
+DEFLATED = 8
+
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_UTF8 = 0x800
+
+ZIP64_EXTRA_ID = 0x0001
+ZIP64_LIMIT = 0xffffffff
+
+CREATE_SYSTEM_UNIX = 3
+
+CHUNK_SIZE = 64 * 1024
+
+class _StreamReader(object):
+  """
+  Reads exact amounts from a file-like object, with support for pushing back
+  data that was read too eagerly.
+  """
+  def __init__(self, stream):
+    self._stream = stream
+    self._pending = ''
+
+  def read_some(self, size):
+    if self._pending:
+      data = self._pending[:size]
+      self._pending = self._pending[size:]
+      return data
+    return self._stream.read(size)
+
+  def read(self, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+      data = self.read_some(min(remaining, CHUNK_SIZE * 16))
+      if not data:
+        raise Exception('Unexpected end of zip stream, %d bytes missing' %
+                        remaining)
+      chunks.append(data)
+      remaining -= len(data)
+    return ''.join(chunks)
+
+  def unread(self, data):
+    self._pending = data + self._pending
+
+def _DecodeName(raw_name, flags):
+  if flags & FLAG_UTF8:
+    return raw_name.decode('utf-8')
+  return raw_name.decode('cp437')
+
+def _Zip64Sizes(extra, compressed_size, uncompressed_size):
+  # The zip64 extra field only holds the sizes that overflowed, uncompressed
+  # size first.
+  while len(extra) >= 4:
+    header_id, length = struct.unpack('<HH', extra[:4])
+    if header_id == ZIP64_EXTRA_ID:
+      values = extra[4:4 + length]
+      if uncompressed_size == ZIP64_LIMIT:
+        uncompressed_size, = struct.unpack('<Q', values[:8])
+        values = values[8:]
+      if compressed_size == ZIP64_LIMIT:
+        compressed_size, = struct.unpack('<Q', values[:8])
+      return True, compressed_size, uncompressed_size
+    extra = extra[4 + length:]
+  return False, compressed_size, uncompressed_size
+
+def _TargetPath(destination, name):
+  # Like zipfile.extractall, never write outside of destination: drop drive
+  # letters, '..' and any other part that could escape it on windows.
+  name = os.path.splitdrive(name.replace('\\', '/'))[1]
+  parts = [part for part in name.split('/')
+           if part not in ('', '.', '..') and ':' not in part]
+  if not parts:
+    return None
+  return os.path.join(destination, *parts)
+
+def _MakeDirs(path):
+  if not os.path.isdir(path):
+    os.makedirs(path)
+
+def _InflateUntilEnd(reader):
+  """
+  Inflates a deflate stream of unknown length, pushing back whatever follows
+  it. Used for members written with a trailing data descriptor.
+  """
+  decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+  chunks = []
+  while not decompressor.unused_data:
+    data = reader.read_some(CHUNK_SIZE)
+    if not data:
+      raise Exception('Unexpected end of zip stream in deflated member')
+    chunks.append(decompressor.decompress(data))
+  chunks.append(decompressor.flush())
+  reader.unread(decompressor.unused_data)
+  return ''.join(chunks)
+
+def _ReadDataDescriptor(reader, is_zip64):
+  signature, = struct.unpack('<I', reader.read(4))
+  if signature == DATA_DESCRIPTOR_SIGNATURE:
+    crc, = struct.unpack('<I', reader.read(4))
+  else:
+    # The signature is optional, in which case we just read the crc.
+    crc = signature
+  reader.read(16 if is_zip64 else 8)
+  return crc
+
+def _ExtractMember(path, method, crc, data):
+  if method == DEFLATED:
+    data = zlib.decompress(data, -zlib.MAX_WBITS)
+  elif method != STORED:
+    raise Exception('Unsupported compression method %d for %s' %
+                    (method, path))
+  if zlib.crc32(data) & 0xffffffff != crc:
+    raise Exception('Bad CRC-32 for %s' % path)
+  with open(path, 'wb') as f:
+    f.write(data)
+
+def _Worker(jobs, errors):
+  while True:
+    job = jobs.get()
+    if job is None:
+      return
+    # After the first error keep draining the queue so the reader never blocks.
+    if errors:
+      continue
+    try:
+      _ExtractMember(*job)
+    except Exception as e:
+      errors.append(e)
+
+def _ReadLocalMembers(reader, destination, jobs, errors):
+  """
+  Reads local file headers and their data until the central directory starts,
+  handing each member to the extraction workers.
+  Returns the signature that ended the local members.
+  """
+  while not errors:
+    signature, = struct.unpack('<I', reader.read(4))
+    if signature != LOCAL_HEADER_SIGNATURE:
+      return signature
+    (_, flags, method, _, _, crc, compressed_size, uncompressed_size,
+     name_length, extra_length) = LOCAL_HEADER.unpack(
+        reader.read(LOCAL_HEADER.size))
+    name = _DecodeName(reader.read(name_length), flags)
+    is_zip64, compressed_size, _ = _Zip64Sizes(
+        reader.read(extra_length), compressed_size, uncompressed_size)
+    path = _TargetPath(destination, name)
+
+    if flags & FLAG_DATA_DESCRIPTOR:
+      if method != DEFLATED:
+        raise Exception('Cannot stream %s: stored member without sizes' % name)
+      data = _InflateUntilEnd(reader)
+      method = STORED
+      crc = _ReadDataDescriptor(reader, is_zip64)
+    else:
+      data = reader.read(compressed_size)
+
+    if path is None:
+      continue
+    if name.endswith('/'):
+      _MakeDirs(path)
+      continue
+    _MakeDirs(os.path.dirname(path))
+    jobs.put((path, method, crc, data))
+  return None
+
+def _ReadModes(reader, signature, destination):
+  """
+  Reads the central directory, which is the only place the unix permission
+  bits are stored. Returns a list of (path, mode) pairs.
+  """
+  modes = []
+  while signature == CENTRAL_HEADER_SIGNATURE:
+    (created_by, _, flags, _, _, _, _, _, _, name_length, extra_length,
+     comment_length, _, _, external_attributes, _) = CENTRAL_HEADER.unpack(
+        reader.read(CENTRAL_HEADER.size))
+    name = _DecodeName(reader.read(name_length), flags)
+    reader.read(extra_length + comment_length)
+    mode = external_attributes >> 16
+    path = _TargetPath(destination, name)
+    if created_by >> 8 == CREATE_SYSTEM_UNIX and mode and path is not None:
+      modes.append((path, mode))
+    signature, = struct.unpack('<I', reader.read(4))
+  if signature not in END_SIGNATURES:
+    raise Exception('Bad zip record signature 0x%08x' % signature)
+  # Skip the end of central directory records.
+  while reader.read_some(CHUNK_SIZE):
+    pass
+  return modes
+
+def _ApplyMode(path, mode):
+  if stat.S_ISLNK(mode):
+    with open(path, 'rb') as f:
+      target = f.read()
+    os.remove(path)
+    os.symlink(target, path)
+  elif not stat.S_ISDIR(mode) or os.path.isdir(path):
+    os.chmod(path, stat.S_IMODE(mode))
+
+def ExtractZipStream(stream, destination, threads=None):
+  """
+  Extracts the zip archive read from the file-like object stream into
+  destination.
+
+  The archive is read front to back, so stream can be a download that is never
+  written to disk. Members are decompressed, checked against their CRC-32 and
+  written by a pool of threads. Once the central directory at the end of the
+  archive has been read, the unix permission bits are restored (and symlinks
+  recreated) on posix, which zipfile.extractall does not do.
+  """
+  threads = threads or multiprocessing.cpu_count()
+  reader = _StreamReader(stream)
+  # Bound the queue so we don't buffer the whole archive in memory.
+  jobs = Queue.Queue(maxsize=threads * 2)
+  errors = []
+  workers = [threading.Thread(target=_Worker, args=(jobs, errors))
+             for _ in range(threads)]
+  for worker in workers:
+    worker.daemon = True
+    worker.start()
+  try:
+    signature = _ReadLocalMembers(reader, destination, jobs, errors)
+  finally:
+    for worker in workers:
+      jobs.put(None)
+    for worker in workers:
+      worker.join()
+  if errors:
+    raise errors[0]
+
+  modes = _ReadModes(reader, signature, destination)
+  if os.name == 'posix':
+    # Like unzip, set directory permissions last and deepest first, so a
+    # read-only directory doesn't stop us from fixing up its contents.
+    directories = sorted([(path, mode) for path, mode in modes
+                          if stat.S_ISDIR(mode)],
+                         key=lambda (path, _): -path.count(os.sep))
+    for path, mode in modes:
+      if not stat.S_ISDIR(mode):
+        _ApplyMode(path, mode)
+    for path, mode in directories:
+      _ApplyMode(path, mode)
+
+def _Snapshot(root):
+  snapshot = {}
+  for dirpath, dirnames, filenames in os.walk(root):
+    for name in dirnames + filenames:
+      path = os.path.join(dirpath, name)
+      mode = os.lstat(path).st_mode
+      if stat.S_ISLNK(mode):
+        content = os.readlink(path)
+      elif stat.S_ISDIR(mode):
+        content = None
+      else:
+        with open(path, 'rb') as f:
+          content = f.read()
+      snapshot[os.path.relpath(path, root)] = (mode, content)
+  return snapshot
+
+def _MakeWritable(root):
+  for dirpath, dirnames, _ in os.walk(root):
+    for name in dirnames:
+      os.chmod(os.path.join(dirpath, name), 0755)
+
+def _WriteWithZipfile(source, archive, compression):
+  import zipfile
+  with zipfile.ZipFile(archive, 'w', compression) as zip_file:
+    for dirpath, dirnames, filenames in os.walk(source):
+      for name in dirnames + filenames:
+        path = os.path.join(dirpath, name)
+        arcname = os.path.relpath(path, source)
+        if os.path.islink(path):
+          info = zipfile.ZipInfo(arcname)
+          info.create_system = CREATE_SYSTEM_UNIX
+          info.external_attr = os.lstat(path).st_mode << 16
+          zip_file.writestr(info, os.readlink(path))
+        else:
+          zip_file.write(path, arcname)
+
+def _SelfTest():
+  """
+  Builds archives of a small tree with zipfile and, if available, zip, and
+  checks that extracting them reproduces the tree including modes and
+  symlinks, and that corrupt or truncated archives are rejected.
+  """
+  import shutil
+  import StringIO
+  import subprocess
+  import tempfile
+  import zipfile
+
+  temp_dir = tempfile.mkdtemp()
+  try:
+    source = os.path.join(temp_dir, 'source')
+    os.makedirs(os.path.join(source, 'bin'))
+    os.makedirs(os.path.join(source, 'lib', 'read_only'))
+    with open(os.path.join(source, 'bin', 'dart'), 'wb') as f:
+      f.write(os.urandom(300000))
+    os.chmod(os.path.join(source, 'bin', 'dart'), 0755)
+    with open(os.path.join(source, 'lib', 'read_only', 'core.dart'), 'wb') as f:
+      f.write('stored marker\n' + '\n'.join(str(i) for i in range(100000)))
+    os.chmod(os.path.join(source, 'lib', 'read_only', 'core.dart'), 0644)
+    os.symlink('core.dart', os.path.join(source, 'lib', 'read_only', 'link'))
+    os.chmod(os.path.join(source, 'lib', 'read_only'), 0555)
+    expected = _Snapshot(source)
+
+    archives = {}
+    for name, compression in [('stored', zipfile.ZIP_STORED),
+                              ('deflated', zipfile.ZIP_DEFLATED)]:
+      archive = os.path.join(temp_dir, '%s.zip' % name)
+      _WriteWithZipfile(source, archive, compression)
+      archives[name] = archive
+    try:
+      archive = os.path.join(temp_dir, 'zip.zip')
+      subprocess.check_call(['zip', '-qyr', archive, '.'], cwd=source)
+      archives['zip'] = archive
+      # Writing to stdout makes zip use data descriptors.
+      archive = os.path.join(temp_dir, 'zip_stream.zip')
+      with open(archive, 'wb') as f:
+        subprocess.check_call(['zip', '-qyr', '-', '.'], cwd=source, stdout=f)
+      archives['zip_stream'] = archive
+    except OSError:
+      print 'zip not found, only testing archives written by zipfile'
+
+    for name, archive in sorted(archives.items()):
+      destination = os.path.join(temp_dir, 'out_%s' % name)
+      with open(archive, 'rb') as f:
+        ExtractZipStream(f, destination, threads=3)
+      if _Snapshot(destination) != expected:
+        raise Exception('Extracting %s did not reproduce the tree' % name)
+      _MakeWritable(destination)
+      print 'ok: %s' % name
+
+    with open(archives['stored'], 'rb') as f:
+      data = f.read()
+    corrupt = data.replace('stored marker', 'stored market', 1)
+    truncated = data[:len(data) / 2]
+    for name, data in [('corrupt', corrupt), ('truncated', truncated)]:
+      try:
+        ExtractZipStream(StringIO.StringIO(data),
+                         os.path.join(temp_dir, 'out_%s' % name))
+      except Exception as e:
+        print 'ok: %s (%s)' % (name, e)
+      else:
+        raise Exception('Extracting a %s archive did not fail' % name)
+      _MakeWritable(os.path.join(temp_dir, 'out_%s' % name))
+  finally:
+    _MakeWritable(temp_dir)
+    shutil.rmtree(temp_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+  _SelfTest()